@@ -7,7 +7,7 @@ _semacro() {
     _init_completion || return
 
     local subcommands="lookup find list callers which telookup deps init"
-    local global_opts="--no-color --include-path --version --help"
+    local global_opts="--no-color --include-path --reindex --version --help"
     local lookup_opts="-e --expand -r --rules -d --depth --help"
     local find_opts="-p --perms --help"
     local list_opts="-c --category --help"
@@ -10,13 +10,23 @@ import pickle
 import re
 import signal
 import sys
+from bisect import bisect_left, bisect_right
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from dataclasses import dataclass, field
+from functools import cached_property, lru_cache
 from pathlib import Path
 
+try:
+    import re2  # optional (google-re2): linear-time matching for user patterns
+except ImportError:
+    re2 = None
+
 
 # --- Data model ---
 
-@dataclass
+@dataclass(slots=True)
 class MacroDef:
     """A parsed macro definition (interface, template, or define)."""
     name: str
@@ -24,11 +34,89 @@ class MacroDef:
     body: str
     source_file: str   # path relative to include root
     line_number: int
+    category: str = "other"  # policy category from _CATEGORY_DIRS
 
     def display_body(self) -> str:
         return f"{self.kind}(`{self.name}',`\n{self.body}\n')"
 
 
+class MacroIndex(dict):
+    """Macro name -> MacroDef, plus lookup tables derived from it.
+
+    Behaves exactly like a dict.  Derived tables are built on first use
+    and cached on the instance; the index is not mutated after building.
+    """
+
+    # Completeness flags, set while the index is assembled: whether any
+    # define was found, and whether any macro came from a kernel/ file.
+    has_define = False
+    has_kernel = False
+
+    @cached_property
+    def sorted_names(self) -> list[str]:
+        """All macro names in sorted order, for listings."""
+        return sorted(self)
+
+    @cached_property
+    def lower_names(self) -> list[tuple[str, str]]:
+        """(lowercased name, name) pairs, in sorted order, for case-insensitive substring search."""
+        return [(name.lower(), name) for name in self.sorted_names]
+
+    @cached_property
+    def folded_names(self) -> list[tuple[str, str]]:
+        """lower_names sorted by lowercased name, for prefix search by bisection."""
+        return sorted(self.lower_names)
+
+    @cached_property
+    def plain_defines(self) -> dict[str, str]:
+        """Defines without positional args ($N), mapped to their stripped body."""
+        return {
+            name: macro.body.strip() for name, macro in self.items()
+            if macro.kind == "define" and "$" not in macro.body
+        }
+
+    @cached_property
+    def callers(self) -> dict[str, set[str]]:
+        """Reverse call graph: macro name -> names of macros that call it directly."""
+        graph: dict[str, set[str]] = {}
+        for name, macro in self.items():
+            for call_name, _args, _start, _end in find_calls_in_body(macro.body):
+                if call_name != name:
+                    graph.setdefault(call_name, set()).add(name)
+        return graph
+
+    @cached_property
+    def av_producers(self) -> frozenset[str]:
+        """Macros whose expansion can emit an access vector rule."""
+        return self._rule_producers(("allow", "dontaudit"))
+
+    @cached_property
+    def transition_producers(self) -> frozenset[str]:
+        """Macros whose expansion can emit a type_transition rule."""
+        return self._rule_producers(("type_transition",))
+
+    def _rule_producers(self, keywords: tuple[str, ...]) -> frozenset[str]:
+        """Names of macros that may emit a rule containing one of *keywords*.
+
+        A macro qualifies if its own body mentions a keyword, if it builds a
+        call name from its arguments (which can't be resolved statically),
+        or if it calls a macro that qualifies.  The result over-approximates,
+        so skipping macros outside it never loses a match.
+        """
+        found = {
+            name for name, macro in self.items()
+            if any(kw in macro.body for kw in keywords)
+            or _DYNAMIC_CALL.search(macro.body)
+        }
+        stack = list(found)
+        while stack:
+            for caller in self.callers.get(stack.pop(), ()):
+                if caller not in found:
+                    found.add(caller)
+                    stack.append(caller)
+        return frozenset(found)
+
+
 # --- Color helpers ---
 
 class Color:
@@ -40,74 +128,137 @@ class Color:
     DIM = "\033[2m"
     RESET = "\033[0m"
 
-_use_color = True
+def _colored(text: str, *codes: str) -> str:
+    return f"{''.join(codes)}{text}\033[0m"
+
+
+def _plain(text: str, *codes: str) -> str:
+    return text
 
-def colored(text: str, *codes: str) -> str:
-    if not _use_color:
-        return text
-    return "".join(codes) + text + Color.RESET
+
+# main() rebinds this to _plain when color is off, so uncolored output
+# pays no per-call check.
+colored = _colored
 
 
 # --- M4 parser ---
 
-def _find_m4_block_end(text: str, start: int) -> int:
+def _find_m4_block_end(text: str | bytes, start: int) -> int:
     """Find the matching closing quote for an M4 backtick-quoted block.
 
     Starting after the opening backtick at `start`, tracks nesting of
     backtick/single-quote pairs and returns the index of the closing
-    single quote.  Returns -1 if unmatched.
+    single quote.  Returns -1 if unmatched.  Works on str or bytes.
     """
+    if isinstance(text, bytes):
+        open_quote, close_quote = b"`", b"'"
+    else:
+        open_quote, close_quote = "`", "'"
     depth = 1
     i = start
-    while i < len(text):
-        ch = text[i]
-        if ch == '`':
+    find = text.find
+    # Hop between quote characters with str.find rather than stepping
+    # through the text one character at a time.
+    close = find(close_quote, i)
+    while close != -1:
+        open_ = find(open_quote, i, close)
+        if open_ != -1:
             depth += 1
-        elif ch == "'":
+            i = open_ + 1
+        else:
             depth -= 1
             if depth == 0:
-                return i
-        i += 1
+                return close
+            i = close + 1
+            close = find(close_quote, i)
     return -1
 
 
+# Policy files are scanned as bytes (they are ASCII in practice); only the
+# pieces that end up in a MacroDef are decoded.
 _MACRO_START = re.compile(
-    r"^(interface|template|define)\(\s*`([^']+)'\s*,\s*`",
+    rb"^(interface|template|define)\(\s*`([^']+)'\s*,\s*`",
     re.MULTILINE,
 )
 
+# Every _MACRO_START match contains one of these; a plain substring test
+# lets files without any definitions skip the regex scan entirely.
+_MACRO_KEYWORDS = (b"interface(", b"template(", b"define(")
+
+
+_CATEGORY_DIRS = {
+    "kernel":      {"kernel"},
+    "system":      {"system"},
+    "admin":       {"admin"},
+    "apps":        {"apps"},
+    "roles":       {"roles"},
+    "services":    {"services"},
+    "contrib":     {"contrib"},
+    "distributed": {"distributed"},
+    "support":     {"support"},
+}
+
+# Directory name -> category, for tagging macros as files are parsed.
+_DIR_CATEGORY = {d: cat for cat, dirs in _CATEGORY_DIRS.items() for d in dirs}
+
+
+def _category_of(rel_path: str) -> str:
+    """Category of the first directory in rel_path that names one, else "other"."""
+    for part in rel_path.split(os.sep)[:-1]:
+        category = _DIR_CATEGORY.get(part)
+        if category is not None:
+            return category
+    return "other"
+
 
 def parse_file(filepath: str, rel_path: str) -> list[MacroDef]:
     """Parse a .if or .spt file, extracting all macro definitions."""
     try:
-        text = Path(filepath).read_text(encoding="utf-8", errors="replace")
+        fd = os.open(filepath, os.O_RDONLY)
+        try:
+            data = os.read(fd, os.fstat(fd).st_size)
+        finally:
+            os.close(fd)
     except OSError:
         return []
 
+    # Translate newlines the way text-mode reading would, so CRLF files
+    # yield the same bodies and line numbers as LF ones.
+    if b"\r" in data:
+        data = data.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+
+    if not any(kw in data for kw in _MACRO_KEYWORDS):
+        return []
+
+    category = _category_of(rel_path)
     results: list[MacroDef] = []
-    for m in _MACRO_START.finditer(text):
-        kind = m.group(1)
-        name = m.group(2)
+    # Matches come in file order, so count newlines incrementally from the
+    # previous match instead of from the top of the file each time.
+    line_number = 1
+    counted = 0
+    for m in _MACRO_START.finditer(data):
         body_start = m.end()
-        body_end = _find_m4_block_end(text, body_start)
+        body_end = _find_m4_block_end(data, body_start)
         if body_end == -1:
             continue
 
-        body = text[body_start:body_end]
-
-        # Strip one leading/trailing newline from body if present
-        if body.startswith("\n"):
-            body = body[1:]
-        if body.endswith("\n"):
-            body = body[:-1]
+        # Strip one leading/trailing newline from body if present, by
+        # moving the slice bounds so the body is sliced and decoded once.
+        if data[body_start] == 0x0A:
+            body_start += 1
+        if body_end > body_start and data[body_end - 1] == 0x0A:
+            body_end -= 1
+        body = data[body_start:body_end].decode("utf-8", errors="replace")
 
-        line_number = text[:m.start()].count("\n") + 1
+        line_number += data.count(b"\n", counted, m.start())
+        counted = m.start()
         results.append(MacroDef(
-            name=name,
-            kind=kind,
+            name=m.group(2).decode("utf-8", errors="replace"),
+            kind=sys.intern(m.group(1).decode("ascii")),
             body=body,
             source_file=rel_path,
             line_number=line_number,
+            category=category,
         ))
 
     return results
@@ -120,13 +271,38 @@ _STANDARD_PATHS = [
 ]
 
 
-def _has_policy_files(path: str) -> bool:
-    """Check if a directory tree contains any .if or .spt files."""
-    for dirpath, _dirs, filenames in os.walk(path):
-        for f in filenames:
-            if f.endswith(".if") or f.endswith(".spt"):
-                return True
-    return False
+_SUFFIXES = (".if", ".spt")
+
+
+def _iter_policy_files(root: str) -> Iterator[tuple[str, str]]:
+    """Yield (full path, path relative to root) for every .if/.spt file under root.
+
+    Uses os.scandir, whose directory entries already know their type, so
+    no per-file stat is needed.  Hidden directories are skipped.  Entries
+    are visited in sorted order so the result is stable across runs.
+    """
+    # (directory, its path relative to root with a trailing separator)
+    stack = [(root, "")]
+    while stack:
+        subdirs: list[tuple[str, str]] = []
+        directory, rel_dir = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if not entry.name.startswith("."):
+                    subdirs.append((entry.path, rel_dir + entry.name + os.sep))
+            elif entry.name.endswith(_SUFFIXES):
+                yield entry.path, rel_dir + entry.name
+        stack.extend(reversed(subdirs))
+
+
+def _collect_policy_files(root: str) -> list[tuple[str, str]]:
+    """All of _iter_policy_files(root), as a list."""
+    return list(_iter_policy_files(root))
 
 
 def detect_include_path() -> str | None:
@@ -135,40 +311,80 @@ def detect_include_path() -> str | None:
     Returns a path only if it actually contains .if or .spt files.
     """
     for p in _STANDARD_PATHS:
-        if os.path.isdir(p) and _has_policy_files(p):
+        if os.path.isdir(p) and next(_iter_policy_files(p), None) is not None:
             return p
     return None
 
 
-def build_index(include_path: str) -> dict[str, MacroDef]:
-    """Walk include_path, parse all .if and .spt files, return name -> MacroDef."""
-    index: dict[str, MacroDef] = {}
-    for dirpath, _dirnames, filenames in os.walk(include_path):
-        for fname in filenames:
-            if not (fname.endswith(".if") or fname.endswith(".spt")):
-                continue
-            full = os.path.join(dirpath, fname)
-            rel = os.path.relpath(full, include_path)
-            for macro in parse_file(full, rel):
-                index[macro.name] = macro
+# Below this many files, process pool start-up costs more than it saves.
+_PARALLEL_MIN_FILES = 50
+
+
+def _parse_one(pair: tuple[str, str]) -> list[MacroDef]:
+    """parse_file() taking a single (full, rel) tuple, for ProcessPoolExecutor.map."""
+    return parse_file(*pair)
+
+
+def _parse_files(pairs: list[tuple[str, str]]) -> list[list[MacroDef]]:
+    """Parse (full, rel) file pairs, fanning out to worker processes for large trees.
+
+    Results are returned in the same order as *pairs*.
+    """
+    if len(pairs) >= _PARALLEL_MIN_FILES:
+        try:
+            with ProcessPoolExecutor() as ex:
+                return list(ex.map(_parse_one, pairs, chunksize=32))
+        except (OSError, BrokenProcessPool):
+            # No usable worker processes (e.g. a sandbox without
+            # semaphores, or a worker was killed) -- parse in-process.
+            pass
+    return [_parse_one(pair) for pair in pairs]
+
+
+def _index_from(parsed: Iterable[list[MacroDef]]) -> MacroIndex:
+    """Assemble a MacroIndex from per-file macro lists, in include-tree order."""
+    index = MacroIndex()
+    for macros in parsed:
+        if macros and "kernel" in macros[0].source_file:
+            index.has_kernel = True
+        for macro in macros:
+            index[macro.name] = macro
+            if macro.kind == "define":
+                index.has_define = True
+    # Build the derived tables now so they are stored with the on-disk cache.
+    index.sorted_names
+    index.folded_names
+    index.plain_defines
+    index.callers
     return index
 
 
+def build_index(include_path: str, files: list[tuple[str, str]] | None = None) -> MacroIndex:
+    """Parse all .if and .spt files under include_path, return name -> MacroDef.
+
+    *files* is the result of _collect_policy_files(include_path), if the
+    caller already has it.
+    """
+    if files is None:
+        files = _collect_policy_files(include_path)
+    return _index_from(_parse_files(files))
+
+
 # --- Index caching ---
 
 _CACHE_DIR = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "semacro"
 
+# Bump when the pickled index layout changes so stale caches are rebuilt.
+_CACHE_VERSION = 13
+
 
-def _source_fingerprint(include_path: str) -> str:
-    """Hash of all .if/.spt file paths and their modification times."""
-    entries: list[str] = []
-    for dirpath, _dirs, filenames in os.walk(include_path):
-        for fname in sorted(filenames):
-            if fname.endswith(".if") or fname.endswith(".spt"):
-                full = os.path.join(dirpath, fname)
-                mtime = os.path.getmtime(full)
-                entries.append(f"{full}:{mtime}")
-    return hashlib.sha256("\n".join(entries).encode()).hexdigest()[:16]
+def _file_stamps(files: list[tuple[str, str]]) -> dict[str, tuple[int, int]]:
+    """Map each file's relative path to its (mtime_ns, size)."""
+    stamps = {}
+    for full, rel in files:
+        st = os.stat(full)
+        stamps[rel] = (st.st_mtime_ns, st.st_size)
+    return stamps
 
 
 def _cache_path(include_path: str) -> Path:
@@ -176,51 +392,113 @@ def _cache_path(include_path: str) -> Path:
     return _CACHE_DIR / f"index-{path_hash}.pickle"
 
 
-def load_or_build_index(include_path: str) -> dict[str, MacroDef]:
-    """Load cached index if valid, otherwise build fresh and cache it."""
-    cache = _cache_path(include_path)
-    fingerprint = _source_fingerprint(include_path)
+def _load_cache(
+    cache: Path,
+) -> tuple[dict[str, tuple[int, int]], dict[str, list[MacroDef]], MacroIndex] | None:
+    """Return (stamps, per-file macros, index) from a cache file, or None.
+
+    A missing, corrupt or older-format cache is never fatal -- it just
+    means everything is parsed again.
+    """
+    try:
+        with open(cache, "rb") as f:
+            version, stamps, parsed, index = pickle.load(f)
+    except Exception:
+        return None
+    if version != _CACHE_VERSION:
+        return None
+    return stamps, parsed, index
 
-    if cache.exists():
-        try:
-            with open(cache, "rb") as f:
-                saved_fp, index = pickle.load(f)
-            if saved_fp == fingerprint:
-                return index
-        except (pickle.UnpicklingError, ValueError, EOFError, OSError):
-            pass
 
-    index = build_index(include_path)
+def load_or_build_index(include_path: str, reindex: bool = False) -> MacroIndex:
+    """Load the cached index, re-parsing only the files that changed since it was written.
 
+    With *reindex*, ignore any existing cache and parse every file.
+    """
+    cache = _cache_path(include_path)
+    files = _collect_policy_files(include_path)
+    stamps = _file_stamps(files)
+
+    reusable: dict[str, list[MacroDef]] = {}
+    cached = None if reindex else _load_cache(cache)
+    if cached is not None:
+        old_stamps, old_parsed, index = cached
+        if old_stamps == stamps:
+            return index
+        reusable = {rel: old_parsed[rel] for rel, stamp in stamps.items()
+                    if old_stamps.get(rel) == stamp and rel in old_parsed}
+
+    stale = [(full, rel) for full, rel in files if rel not in reusable]
+    for (_full, rel), macros in zip(stale, _parse_files(stale)):
+        reusable[rel] = macros
+    parsed = {rel: reusable[rel] for _full, rel in files}
+    index = _index_from(parsed.values())
+
+    # Write to a temp file and rename, so a concurrent semacro never
+    # reads a half-written cache.
+    tmp = cache.with_name(f"{cache.name}.{os.getpid()}.tmp")
     try:
         _CACHE_DIR.mkdir(parents=True, exist_ok=True)
-        with open(cache, "wb") as f:
-            pickle.dump((fingerprint, index), f, protocol=pickle.HIGHEST_PROTOCOL)
+        with open(tmp, "wb") as f:
+            pickle.dump((_CACHE_VERSION, stamps, parsed, index), f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, cache)
     except OSError:
-        pass
+        try:
+            tmp.unlink(missing_ok=True)
+        except OSError:
+            pass
 
     return index
 
 
 # --- Call parsing and expansion ---
 
-_CALL_PATTERN = re.compile(r"^(\w+)\((.+)\)$", re.DOTALL)
-
 def parse_call(text: str) -> tuple[str, list[str]] | None:
     """Parse 'name(arg1, arg2, ...)' into (name, [arg1, arg2, ...]).
 
     Returns None if the text is a plain name with no parentheses.
     """
     text = text.strip()
-    m = _CALL_PATTERN.match(text)
-    if not m:
+    lp = text.find("(")
+    # Same shape the old ^(\w+)\((.+)\)$ regex accepted: a word, then a
+    # non-empty argument list running to a closing paren at the very end.
+    if lp < 1 or lp + 2 >= len(text) or not text.endswith(")"):
+        return None
+    name = text[:lp]
+    if not name.replace("_", "a").isalnum():
         return None
-    name = m.group(1)
-    args_str = m.group(2)
-    args = [a.strip() for a in args_str.split(",")]
+    args = [a.strip() for a in text[lp + 1:-1].split(",")]
     return name, args
 
 
+_ARG_REF = re.compile(r'\$(\d+|\*)')
+
+# Template slot meaning "all arguments" ($*); positive slots are $N.
+_ALL_ARGS = 0
+
+
+@lru_cache(maxsize=4096)
+def _arg_template(body: str) -> tuple:
+    """Split a body into alternating literal text and argument slots.
+
+    Returns (text, slot, text, slot, ..., text), where each slot is N for
+    $N or _ALL_ARGS for $*.  $0 (the macro name) stays in the literal text.
+    Cached per body, so each macro is split only once.
+    """
+    parts = _ARG_REF.split(body)
+    template = [parts[0]]
+    for i in range(1, len(parts), 2):
+        ref, text = parts[i], parts[i + 1]
+        if ref == "*":
+            template += [_ALL_ARGS, text]
+        elif int(ref) == 0:
+            template[-1] += "$" + ref + text
+        else:
+            template += [int(ref), text]
+    return tuple(template)
+
+
 def substitute_args(body: str, args: list[str]) -> str:
     """Replace $1, $2, ... $N with the provided arguments.
 
@@ -228,20 +506,69 @@ def substitute_args(body: str, args: list[str]) -> str:
     matching M4 behavior.  Also handles $* (all args as comma-separated)
     and leaves $0 as-is (macro name).
     """
-    def _replacer(m: re.Match) -> str:
-        idx = int(m.group(1))
-        if idx == 0:
-            return m.group(0)
-        if 1 <= idx <= len(args):
-            return args[idx - 1]
-        return ""
-
-    result = re.sub(r'\$(\d+)', _replacer, body)
-    result = result.replace("$*", ",".join(args))
-    return result
-
+    if "$" not in body:
+        return body
+    template = _arg_template(body)
+    pieces = [template[0]]
+    for i in range(1, len(template), 2):
+        slot = template[i]
+        if slot == _ALL_ARGS:
+            pieces.append(",".join(args))
+        elif slot <= len(args):
+            pieces.append(args[slot - 1])
+        pieces.append(template[i + 1])
+    return "".join(pieces)
+
+
+_BODY_CALL = re.compile(r"\b(\w+)\(([^()]*)\)")
+
+# A call whose name is assembled from arguments, e.g. $1_domtrans(...).
+_DYNAMIC_CALL = re.compile(r"\$[\d*]\w*\(")
+
+# Names that look like calls but are policy statements or M4 built-ins.
+_NON_MACRO_CALLS = frozenset({
+    "allow", "dontaudit", "auditallow", "neverallow",
+    "type_transition", "type_change", "type_member",
+    "role_transition", "range_transition",
+    "gen_require", "optional_policy", "tunable_policy",
+    "require", "type", "role", "attribute", "bool",
+    "ifdef", "ifndef", "refpolicywarn",
+})
+
+
+_COMMENTED_LINE = re.compile(r"^[^\S\n]*#.*", re.MULTILINE)
+
+
+def _comment_spans(body: str) -> tuple[list[int], list[int]]:
+    """Start and end offsets of every comment line in body."""
+    starts: list[int] = []
+    ends: list[int] = []
+    if "#" in body:
+        for m in _COMMENTED_LINE.finditer(body):
+            starts.append(m.start())
+            ends.append(m.end())
+    return starts, ends
+
+
+def _call_from_match(
+    m: re.Match, comments: tuple[list[int], list[int]], name_group: int = 1,
+) -> tuple[str, list[str]] | None:
+    """Turn a _BODY_CALL-style match into (name, args), or None if it isn't a macro call.
+
+    *comments* comes from _comment_spans() on the matched text.
+    """
+    name = m.group(name_group)
+    if name in _NON_MACRO_CALLS:
+        return None
+    starts, ends = comments
+    if starts:
+        i = bisect_right(starts, m.start()) - 1
+        if i >= 0 and m.start() < ends[i]:
+            return None
+    args_str = m.group(name_group + 1)
+    args = [a.strip() for a in args_str.split(",")] if args_str.strip() else []
+    return name, args
 
-_BODY_CALL = re.compile(r"\b(\w+)\(([^)]*)\)")
 
 def find_calls_in_body(body: str) -> list[tuple[str, list[str], int, int]]:
     """Find macro calls in a body, returning (name, args, start, end) for each.
@@ -249,29 +576,18 @@ def find_calls_in_body(body: str) -> list[tuple[str, list[str], int, int]]:
     Skips lines that are comments, gen_require blocks, and known
     policy statements that aren't macro calls.
     """
-    skip_names = {
-        "allow", "dontaudit", "auditallow", "neverallow",
-        "type_transition", "type_change", "type_member",
-        "role_transition", "range_transition",
-        "gen_require", "optional_policy", "tunable_policy",
-        "require", "type", "role", "attribute", "bool",
-        "ifdef", "ifndef", "refpolicywarn",
-    }
+    if "(" not in body:
+        return []
+    comments = _comment_spans(body)
     calls = []
     for m in _BODY_CALL.finditer(body):
-        name = m.group(1)
-        if name in skip_names:
-            continue
-        line_start = body.rfind("\n", 0, m.start()) + 1
-        line_prefix = body[line_start:m.start()].strip()
-        if line_prefix.startswith("#"):
-            continue
-        args = [a.strip() for a in m.group(2).split(",")] if m.group(2).strip() else []
-        calls.append((name, args, m.start(), m.end()))
+        call = _call_from_match(m, comments)
+        if call:
+            calls.append((*call, m.start(), m.end()))
     return calls
 
 
-@dataclass
+@dataclass(slots=True)
 class ExpansionNode:
     """A node in the expansion tree."""
     text: str
@@ -286,52 +602,119 @@ _GEN_REQUIRE_BLOCK = re.compile(
     re.DOTALL,
 )
 
-def _strip_gen_require(body: str) -> str:
-    """Remove gen_require(`...') blocks from a macro body."""
-    return _GEN_REQUIRE_BLOCK.sub("", body)
+# gen_require blocks and macro calls in one alternation, for _scan_body.
+_BODY_SCAN = re.compile(f"(?P<require>{_GEN_REQUIRE_BLOCK.pattern})|{_BODY_CALL.pattern}")
+
+
+def _scan_body(body: str) -> tuple[str, list[tuple[str, list[str], int, int]]]:
+    """Remove gen_require(`...') blocks and find macro calls in a single pass.
+
+    Same result as find_calls_in_body() on the body with gen_require
+    blocks stripped: returns (stripped_body, calls), with call offsets
+    pointing into the stripped body.
+    """
+    if "(" not in body:
+        return body, []
+    pieces: list[str] = []
+    calls: list[tuple[str, list[str], int, int]] = []
+    comments = _comment_spans(body)
+    last = 0
+    removed = 0
+    for m in _BODY_SCAN.finditer(body):
+        if m.group("require") is not None:
+            pieces.append(body[last:m.start()])
+            last = m.end()
+            removed += m.end() - m.start()
+            continue
+        call = _call_from_match(m, comments, name_group=2)
+        if call:
+            calls.append((*call, m.start() - removed, m.end() - removed))
+    if not pieces:
+        return body, calls
+    pieces.append(body[last:])
+    return "".join(pieces), calls
 
 
 DEFAULT_MAX_DEPTH = 10
 
+# Lines starting with one of these are policy rules even without a trailing ';'.
+_LEAF_PREFIX = re.compile(
+    r"(allow|dontaudit|auditallow|neverallow|type_transition|type_change|type_member|role_transition)\s"
+)
+
 _WORD_TOKEN = re.compile(r'\b([a-zA-Z_]\w+)\b')
 
 
-_NESTED_BRACES = re.compile(r'\{([^{}]*)\{([^{}]*)\}([^{}]*)\}')
+_BRACE = re.compile(r'[{}]')
+_WS_RUN = re.compile(r'\s{2,}')
 
 
 def _flatten_braces(text: str) -> str:
-    """Flatten nested permission brace sets: { a { b c } d } -> { a b c d }."""
-    while _NESTED_BRACES.search(text):
-        text = _NESTED_BRACES.sub(r'{ \1 \2 \3 }', text)
-    text = re.sub(r'\s{2,}', ' ', text)
-    return text
+    """Flatten nested permission brace sets: { a { b c } d } -> { a b c d }.
+
+    Single pass over the brace positions: each outermost group that
+    contains inner braces keeps its own braces and has the inner ones
+    replaced by spaces.  Unbalanced braces are left untouched.
+    """
+    if text.count("{") > 1:
+        pieces: list[str] = []
+        depth = 0
+        last = 0
+        start = 0
+        for m in _BRACE.finditer(text):
+            if m.group() == "{":
+                if depth == 0:
+                    start = m.start()
+                depth += 1
+            elif depth:
+                depth -= 1
+                if depth == 0:
+                    inner = text[start + 1:m.start()]
+                    if "{" in inner:
+                        pieces.append(text[last:start])
+                        pieces.append("{ " + inner.replace("{", " ").replace("}", " ") + " }")
+                        last = m.end()
+        pieces.append(text[last:])
+        text = "".join(pieces)
+    return _WS_RUN.sub(' ', text)
 
 
 def _resolve_defines_in_text(
-    text: str, index: dict[str, MacroDef], track: bool = False,
+    text: str, index: MacroIndex, track: bool = False,
 ) -> str | tuple[str, list[str]]:
     """Inline-expand simple define macros (permission sets, etc.) in a leaf line.
 
     Only resolves defines whose bodies don't reference positional args ($N).
-    Iterates to handle chained defines (e.g. read_file_perms ->
-    read_inherited_file_perms), then flattens any nested brace sets.
+    Each pass replaces every define in the text; passes repeat (up to five)
+    to handle chained defines (e.g. read_file_perms ->
+    read_inherited_file_perms), then nested brace sets are flattened.
 
     When *track* is True, returns (resolved_text, notes) where notes lists
     each define that was resolved as "name -> value".
     """
     notes: list[str] = []
+    changed = False
+    plain_defines = index.plain_defines
+
+    if plain_defines.keys().isdisjoint(_WORD_TOKEN.findall(text)):
+        # Most leaf lines name no define at all; skip the per-word callback.
+        result = _flatten_braces(text)
+        return (result, notes) if track else result
+
+    def _replace(m: re.Match) -> str:
+        nonlocal changed
+        word = m.group(1)
+        resolved_body = plain_defines.get(word)
+        if resolved_body is None:
+            return word
+        if track:
+            notes.append(f"{word} -> {_flatten_braces(resolved_body)}")
+        changed = True
+        return resolved_body
+
     for _ in range(5):
         changed = False
-        for m in _WORD_TOKEN.finditer(text):
-            word = m.group(1)
-            macro = index.get(word)
-            if macro and macro.kind == "define" and "$" not in macro.body:
-                resolved_body = macro.body.strip()
-                if track:
-                    notes.append(f"{word} -> {_flatten_braces(resolved_body)}")
-                text = text[:m.start()] + resolved_body + text[m.end():]
-                changed = True
-                break
+        text = _WORD_TOKEN.sub(_replace, text)
         if not changed:
             break
     result = _flatten_braces(text)
@@ -341,30 +724,72 @@ def _resolve_defines_in_text(
 
 
 def expand_macro(
-    index: dict[str, MacroDef],
+    index: MacroIndex,
     name: str,
     args: list[str],
     depth: int = 0,
     max_depth: int = DEFAULT_MAX_DEPTH,
+    cache: dict[tuple[str, tuple[str, ...], int], ExpansionNode] | None = None,
 ) -> ExpansionNode:
-    """Recursively expand a macro call into an ExpansionNode tree."""
-    call_str = f"{name}({', '.join(args)})" if args else name
-    node = ExpansionNode(text=call_str)
-
-    if depth > max_depth:
-        node.children.append(ExpansionNode(text="... (max depth reached)", is_leaf=True))
+    """Expand a macro call into an ExpansionNode tree.
+
+    Works through an explicit stack of pending nodes rather than recursing.
+    Subtrees are memoized in *cache*, keyed on the call and the remaining
+    depth budget, so a macro called repeatedly with the same arguments is
+    expanded once and its node shared.  Pass the same dict to several
+    calls to share work between them; returned trees must be treated as
+    read-only.
+    """
+    if cache is None:
+        cache = {}
+    pending: list[tuple[ExpansionNode, str, list[str], int]] = []
+    created: list[tuple[str, tuple[str, ...], int]] = []
+
+    def _node_for(call_name: str, call_args: list[str], call_depth: int) -> ExpansionNode:
+        key = (call_name, tuple(call_args), max_depth - call_depth)
+        node = cache.get(key)
+        if node is None:
+            call_str = f"{call_name}({', '.join(call_args)})" if call_args else call_name
+            node = cache[key] = ExpansionNode(text=call_str)
+            created.append(key)
+            if call_depth > max_depth:
+                # Out of depth budget: no need to look the macro up or scan it.
+                node.children.append(ExpansionNode(text="... (max depth reached)", is_leaf=True))
+            else:
+                pending.append((node, call_name, call_args, call_depth))
         return node
 
+    root = _node_for(name, args, depth)
+    try:
+        while pending:
+            node, call_name, call_args, call_depth = pending.pop()
+            _fill_node(index, node, call_name, call_args, call_depth, max_depth, _node_for)
+    except BaseException:
+        # Never leave half-built nodes behind in a shared cache.
+        for key in created:
+            cache.pop(key, None)
+        raise
+    return root
+
+
+def _fill_node(
+    index: MacroIndex,
+    node: ExpansionNode,
+    name: str,
+    args: list[str],
+    depth: int,
+    max_depth: int,
+    node_for: Callable[[str, list[str], int], ExpansionNode],
+) -> None:
+    """Add the children of one call's node; nested calls come from node_for()."""
     macro = index.get(name)
     if not macro:
         node.is_leaf = True
-        return node
+        return
 
     body = substitute_args(macro.body, args) if args else macro.body
+    body, calls = _scan_body(body)
 
-    body = _strip_gen_require(body)
-
-    calls = find_calls_in_body(body)
     if not calls:
         for line in body.strip().splitlines():
             line = line.strip()
@@ -373,16 +798,14 @@ def expand_macro(
                 node.children.append(ExpansionNode(
                     text=resolved, is_leaf=True, define_notes=notes,
                     display_text=line if notes else None))
-        return node
+        return
 
     def _add_leaf_lines(text: str):
         for line in text.splitlines():
             line = line.strip()
             if not line or line.startswith("#"):
                 continue
-            if line.endswith(";") or re.match(
-                r"(allow|dontaudit|auditallow|neverallow|type_transition|type_change|type_member|role_transition)\s", line
-            ):
+            if line.endswith(";") or _LEAF_PREFIX.match(line):
                 resolved, notes = _resolve_defines_in_text(line, index, track=True)
                 node.children.append(ExpansionNode(
                     text=resolved, is_leaf=True, define_notes=notes,
@@ -394,7 +817,7 @@ def expand_macro(
 
         child_macro = index.get(call_name)
         if child_macro:
-            node.children.append(expand_macro(index, call_name, call_args, depth + 1, max_depth))
+            node.children.append(node_for(call_name, call_args, depth + 1))
         else:
             node.children.append(ExpansionNode(
                 text=f"{call_name}({', '.join(call_args)})",
@@ -404,35 +827,37 @@ def expand_macro(
 
     _add_leaf_lines(body[last_end:])
 
-    return node
-
 
-def format_tree(node: ExpansionNode, prefix: str = "", is_last: bool = True, is_root: bool = True) -> str:
-    """Render an ExpansionNode tree with box-drawing characters."""
-    lines = []
+def _format_tree_lines(root: ExpansionNode) -> Iterator[str]:
+    """Yield the lines of an ExpansionNode tree drawn with box-drawing characters.
 
-    show_text = node.display_text if node.display_text else node.text
+    Walks the tree with an explicit stack, so any depth renders without
+    hitting the recursion limit.
+    """
+    stack = [(root, "", True, True)]
+    while stack:
+        node, prefix, is_last, is_root = stack.pop()
+        show_text = node.display_text if node.display_text else node.text
 
-    if is_root:
-        lines.append(colored(show_text, Color.BOLD, Color.CYAN))
-    else:
-        connector = "└── " if is_last else "├── "
-        if node.is_leaf:
-            lines.append(prefix + connector + show_text)
+        if is_root:
+            yield colored(show_text, Color.BOLD, Color.CYAN)
         else:
-            lines.append(prefix + connector + colored(show_text, Color.BOLD, Color.YELLOW))
-
-    note_prefix = prefix + ("    " if is_last else "│   ")
-    if node.is_leaf and node.define_notes:
-        for note in node.define_notes:
-            lines.append(note_prefix + colored(f"  ↳ {note}", Color.DIM))
+            connector = "└── " if is_last else "├── "
+            if node.is_leaf:
+                yield prefix + connector + show_text
+            else:
+                yield prefix + connector + colored(show_text, Color.BOLD, Color.YELLOW)
 
-    child_prefix = prefix + ("    " if is_last else "│   ")
-    for i, child in enumerate(node.children):
-        is_child_last = (i == len(node.children) - 1)
-        lines.append(format_tree(child, child_prefix if not is_root else "", is_child_last, is_root=False))
+        child_prefix = prefix + ("    " if is_last else "│   ")
+        if node.is_leaf and node.define_notes:
+            for note in node.define_notes:
+                yield child_prefix + colored(f"  ↳ {note}", Color.DIM)
 
-    return "\n".join(lines)
+        if is_root:
+            child_prefix = ""
+        last = len(node.children) - 1
+        for i in range(last, -1, -1):
+            stack.append((node.children[i], child_prefix, i == last, False))
 
 
 _AV_RULE = re.compile(
@@ -440,48 +865,51 @@ _AV_RULE = re.compile(
 )
 
 
+def _leaf_texts(node: ExpansionNode, seen: dict[int, ExpansionNode]) -> Iterator[str]:
+    """Yield the leaf lines of an expansion tree in pre-order.
+
+    Memoized expansion shares subtrees between calls, and a shared subtree
+    yields the same leaves every time, so interior nodes already in *seen*
+    (keyed by id()) are skipped.  *seen* holds the nodes themselves, which
+    keeps their ids from being reused, so the same dict can be passed
+    across several trees to skip what earlier trees already produced.
+    """
+    stack = [node]
+    while stack:
+        n = stack.pop()
+        if n.children:
+            if id(n) in seen:
+                continue
+            seen[id(n)] = n
+            stack.extend(reversed(n.children))
+        if n.is_leaf:
+            yield n.text
+
+
 def collect_leaf_rules(node: ExpansionNode) -> list[str]:
     """Walk the expansion tree, deduplicate, and merge access vector rules.
 
     Rules with the same (type, source, target:class) have their permission
     sets unioned.  Non-AV rules (type_transition, etc.) pass through as-is.
     """
-    seen: dict[str, None] = {}
-    def _walk(n: ExpansionNode):
-        if n.is_leaf:
-            seen.setdefault(n.text, None)
-        for child in n.children:
-            _walk(child)
-    _walk(node)
-
-    merged_perms: dict[str, dict[str, None]] = {}
-    merged_order: dict[str, int] = {}
-    other: list[tuple[int, str]] = []
+    return _merge_rules(list(_leaf_texts(node, {})))
 
-    for pos, rule in enumerate(seen):
-        m = _AV_RULE.match(rule)
-        if m:
-            rule_type, source, target_class, perms_str = m.groups()
-            key = f"{rule_type} {source} {target_class}"
-            if key not in merged_perms:
-                merged_perms[key] = {}
-                merged_order[key] = pos
-            for p in perms_str.split():
-                merged_perms[key].setdefault(p, None)
-        else:
-            other.append((pos, rule))
 
-    result: list[tuple[int, str]] = list(other)
-    for key, perms in merged_perms.items():
-        result.append((merged_order[key], f"{key} {{ {' '.join(perms)} }};"))
-    result.sort(key=lambda x: x[0])
-    return [text for _, text in result]
+# --- Commands ---
 
+def _report_not_found(index: MacroIndex, name: str) -> None:
+    """Print a 'not found' error with up to five similarly named macros."""
+    print(f"semacro: macro '{name}' not found", file=sys.stderr)
+    needle = name.lower()
+    near = [n for low, n in index.lower_names if needle in low and n != name]
+    if near:
+        print(f"  Did you mean: {', '.join(sorted(near)[:5])}", file=sys.stderr)
+    else:
+        print(f"  Try: semacro find \"{name}\"", file=sys.stderr)
 
-# --- Commands ---
 
 def cmd_lookup(
-    index: dict[str, MacroDef],
+    index: MacroIndex,
     name: str,
     expand: bool = False,
     rules: bool = False,
@@ -501,12 +929,7 @@ def cmd_lookup(
 
     macro = index.get(macro_name)
     if not macro:
-        print(f"semacro: macro '{macro_name}' not found", file=sys.stderr)
-        near = [n for n in index if macro_name.lower() in n.lower() and n != macro_name]
-        if near:
-            print(f"  Did you mean: {', '.join(sorted(near)[:5])}", file=sys.stderr)
-        else:
-            print(f"  Try: semacro find \"{macro_name}\"", file=sys.stderr)
+        _report_not_found(index, macro_name)
         return 1
 
     if (rules or expand) and not args and _macro_arity(macro) > 0:
@@ -524,7 +947,7 @@ def cmd_lookup(
 
     if expand:
         tree = expand_macro(index, macro_name, args, max_depth=max_depth)
-        print(format_tree(tree))
+        sys.stdout.writelines(f"{line}\n" for line in _format_tree_lines(tree))
         return 0
 
     header = colored(f"{macro.kind}", Color.DIM) + " " + colored(macro.name, Color.BOLD, Color.CYAN)
@@ -539,7 +962,30 @@ def cmd_lookup(
     return 0
 
 
-def cmd_find(index: dict[str, MacroDef], pattern: str | None = None,
+@lru_cache(maxsize=128)
+def _compile_user_pattern(pattern: str):
+    """Compile a case-insensitive name pattern given on the command line.
+
+    Uses RE2 when the optional re2 module is installed, so a pathological
+    pattern can't backtrack for minutes; patterns RE2 can't handle
+    (backreferences, lookaround) fall back to re.  Raises re.error if the
+    pattern is invalid.
+    """
+    if re2 is not None:
+        try:
+            return re2.compile("(?i)" + pattern)
+        except Exception:
+            pass
+    return re.compile(pattern, re.IGNORECASE)
+
+
+def _kind_tags() -> dict[str, str]:
+    """Colored [i]/[t]/[d] tag for each macro kind, built once per listing."""
+    return {kind: colored(f"[{kind[0]}]", Color.YELLOW)
+            for kind in ("interface", "template", "define")}
+
+
+def cmd_find(index: MacroIndex, pattern: str | None = None,
              perms: str | None = None) -> int:
     """Search for macros by name pattern or by permission content."""
     if perms is not None:
@@ -549,32 +995,50 @@ def cmd_find(index: dict[str, MacroDef], pattern: str | None = None,
         print("semacro find: need a pattern or --perms", file=sys.stderr)
         return 1
 
-    try:
-        regex = re.compile(pattern, re.IGNORECASE)
-    except re.error as e:
-        print(f"semacro: invalid regex '{pattern}': {e}", file=sys.stderr)
-        return 1
-
-    matches = sorted(
-        ((name, m) for name, m in index.items() if regex.search(name)),
-        key=lambda pair: pair[0],
-    )
+    literal = pattern[1:] if pattern.startswith("^") else pattern
+    if literal.isascii() and re.escape(literal) == literal:
+        # No regex syntax at all: a plain substring test gives the same
+        # matches without going through the regex engine per name.
+        needle = literal.lower()
+        if literal is pattern:
+            names = [name for low, name in index.lower_names if needle in low]
+        else:
+            # Anchored prefix: the matches are one contiguous run of the
+            # case-folded sorted names, found by bisection.
+            folded = index.folded_names
+            i = bisect_left(folded, (needle,))
+            names = []
+            while i < len(folded) and folded[i][0].startswith(needle):
+                names.append(folded[i][1])
+                i += 1
+            names.sort()
+    else:
+        try:
+            regex = _compile_user_pattern(pattern)
+        except re.error as e:
+            print(f"semacro: invalid regex '{pattern}': {e}", file=sys.stderr)
+            return 1
+        search = regex.search
+        names = [name for name in index.sorted_names if search(name)]
+    matches = [(name, index[name]) for name in names]
 
     if not matches:
         print(f"semacro: no macros matching '{pattern}'", file=sys.stderr)
         print(f"  Patterns are case-insensitive Python regexes. Try a broader pattern.", file=sys.stderr)
         return 1
 
-    for name, macro in matches:
-        source = colored(macro.source_file, Color.DIM)
-        kind_tag = colored(f"[{macro.kind[0]}]", Color.YELLOW)
-        print(f"  {kind_tag} {source}: {colored(name, Color.BOLD)}")
+    kind_tags = _kind_tags()
+    sys.stdout.write("".join(
+        f"  {kind_tags[macro.kind]} {colored(macro.source_file, Color.DIM)}: "
+        f"{colored(name, Color.BOLD)}\n"
+        for name, macro in matches
+    ))
 
     print(colored(f"\n{len(matches)} result(s)", Color.DIM))
     return 0
 
 
-def _find_by_perms(index: dict[str, MacroDef], perms_str: str) -> int:
+def _find_by_perms(index: MacroIndex, perms_str: str) -> int:
     """Find defines whose resolved value contains all requested permissions."""
     requested = set(perms_str.replace(",", " ").split())
     if not requested:
@@ -583,10 +1047,8 @@ def _find_by_perms(index: dict[str, MacroDef], perms_str: str) -> int:
 
     matches: list[tuple[str, str]] = []
 
-    for name, macro in index.items():
-        if macro.kind != "define" or "$" in macro.body:
-            continue
-        resolved = _resolve_defines_in_text(macro.body.strip(), index)
+    for name, value in index.plain_defines.items():
+        resolved = _resolve_defines_in_text(value, index)
         clean = resolved.replace("{", "").replace("}", "").replace(";", "")
         have = set(clean.split())
         if requested <= have:
@@ -599,83 +1061,59 @@ def _find_by_perms(index: dict[str, MacroDef], perms_str: str) -> int:
               file=sys.stderr)
         return 1
 
-    for name, value in matches:
-        print(f"  {colored(name, Color.BOLD)}  {colored(value, Color.DIM)}")
+    sys.stdout.write("".join(
+        f"  {colored(name, Color.BOLD)}  {colored(value, Color.DIM)}\n"
+        for name, value in matches
+    ))
 
     print(colored(f"\n{len(matches)} result(s)", Color.DIM))
     return 0
 
 
-_CATEGORY_DIRS = {
-    "kernel":      {"kernel"},
-    "system":      {"system"},
-    "admin":       {"admin"},
-    "apps":        {"apps"},
-    "roles":       {"roles"},
-    "services":    {"services"},
-    "contrib":     {"contrib"},
-    "distributed": {"distributed"},
-    "support":     {"support"},
-}
-
-
-def cmd_list(index: dict[str, MacroDef], category: str | None) -> int:
+def cmd_list(index: MacroIndex, category: str | None) -> int:
     """List all macros, optionally filtered by category."""
+    wanted = None if category == "all" else category
     entries = []
-    for name, macro in index.items():
-        if category and category != "all":
-            parts = Path(macro.source_file).parts
-            cat_dirs = _CATEGORY_DIRS.get(category, {category})
-            if not any(p in cat_dirs for p in parts):
-                continue
+    for name in index.sorted_names:
+        macro = index[name]
+        if wanted and macro.category != wanted:
+            continue
         entries.append((name, macro))
 
-    entries.sort(key=lambda pair: pair[0])
-
     if not entries:
         print(f"semacro: no macros found for category '{category}'", file=sys.stderr)
         return 1
 
     width = len(str(len(entries)))
-    for i, (name, macro) in enumerate(entries, 1):
-        kind_tag = colored(f"[{macro.kind[0]}]", Color.YELLOW)
-        source = colored(macro.source_file, Color.DIM)
-        num = colored(f"{i:>{width}}", Color.DIM)
-        print(f"  {num}  {kind_tag} {colored(name, Color.BOLD)}  {source}")
+    kind_tags = _kind_tags()
+    sys.stdout.write("".join(
+        f"  {colored(f'{i:>{width}}', Color.DIM)}  {kind_tags[macro.kind]} "
+        f"{colored(name, Color.BOLD)}  {colored(macro.source_file, Color.DIM)}\n"
+        for i, (name, macro) in enumerate(entries, 1)
+    ))
 
     print(colored(f"\n{len(entries)} macro(s)", Color.DIM))
     return 0
 
 
-def cmd_callers(index: dict[str, MacroDef], name: str) -> int:
+def cmd_callers(index: MacroIndex, name: str) -> int:
     """Find which macros directly call the given macro (reverse lookup)."""
     if name not in index:
-        print(f"semacro: macro '{name}' not found", file=sys.stderr)
-        near = [n for n in index if name.lower() in n.lower() and n != name]
-        if near:
-            print(f"  Did you mean: {', '.join(sorted(near)[:5])}", file=sys.stderr)
-        else:
-            print(f"  Try: semacro find \"{name}\"", file=sys.stderr)
+        _report_not_found(index, name)
         return 1
 
-    callers = []
-    for macro_name, macro in index.items():
-        if macro_name == name:
-            continue
-        for call_name, _args, _start, _end in find_calls_in_body(macro.body):
-            if call_name == name:
-                callers.append((macro_name, macro))
-                break
+    callers = sorted(index.callers.get(name, ()))
 
     if not callers:
         print(f"semacro: no macros call '{name}'", file=sys.stderr)
         return 0
 
-    callers.sort(key=lambda pair: pair[0])
-    for caller_name, macro in callers:
-        source = colored(macro.source_file, Color.DIM)
-        kind_tag = colored(f"[{macro.kind[0]}]", Color.YELLOW)
-        print(f"  {kind_tag} {source}: {colored(caller_name, Color.BOLD)}")
+    kind_tags = _kind_tags()
+    sys.stdout.write("".join(
+        f"  {kind_tags[macro.kind]} {colored(macro.source_file, Color.DIM)}: "
+        f"{colored(macro.name, Color.BOLD)}\n"
+        for macro in map(index.__getitem__, callers)
+    ))
 
     print(colored(f"\n{len(callers)} caller(s)", Color.DIM))
     return 0
@@ -729,7 +1167,7 @@ _TT_RULE = re.compile(
 
 
 def cmd_which(
-    index: dict[str, MacroDef],
+    index: MacroIndex,
     source: str,
     target: str,
     third: str,
@@ -749,17 +1187,23 @@ def cmd_which(
     else:
         requested_perms = set(third.split())
 
+    # Only macros that can emit the right kind of rule are worth expanding.
+    producers = index.transition_producers if transition else index.av_producers
+
     candidates: list[tuple[str, MacroDef]] = []
     search_terms = {target}
     if transition:
         search_terms.add(third)
     for macro_name, macro in index.items():
+        if macro_name not in producers:
+            continue
         if macro.kind == "define" and "$" not in macro.body:
             continue
         if any(term in macro.body or term in macro_name for term in search_terms):
             candidates.append((macro_name, macro))
 
     matches: list[tuple[str, str, MacroDef]] = []
+    expand_cache: dict[tuple[str, tuple[str, ...], int], ExpansionNode] = {}
 
     for macro_name, macro in candidates:
         arity = _macro_arity(macro)
@@ -780,7 +1224,8 @@ def cmd_which(
         winning_args: list[str] = []
         for trial_args in trial_sets:
             try:
-                tree = expand_macro(index, macro_name, trial_args, max_depth=5)
+                tree = expand_macro(index, macro_name, trial_args, max_depth=5,
+                                    cache=expand_cache)
             except Exception:
                 continue
             rules = collect_leaf_rules(tree)
@@ -857,7 +1302,7 @@ _TYPE_DECL = re.compile(r'^\s*(type|attribute|typeattribute|typealias|bool|role)
 
 
 def cmd_telookup(
-    index: dict[str, MacroDef],
+    index: MacroIndex,
     filepath: str,
     max_depth: int = DEFAULT_MAX_DEPTH,
     tree_mode: bool = False,
@@ -874,6 +1319,11 @@ def cmd_telookup(
 
     all_rules: list[str] = []
     all_trees: list[ExpansionNode] = []
+    # A .te file tends to call the same few interfaces with the same
+    # types, so expansions are shared across every call in the file.
+    expand_cache: dict[tuple[str, tuple[str, ...], int], ExpansionNode] = {}
+    # Subtrees shared between calls only need their leaves collected once.
+    seen: dict[int, ExpansionNode] = {}
 
     for line in content.splitlines():
         if _COMMENT_LINE.match(line) or _BLANK_LINE.match(line):
@@ -899,16 +1349,16 @@ def cmd_telookup(
                 macro = index.get(call_name)
                 if macro:
                     tree = expand_macro(index, call_name, call_args,
-                                        max_depth=max_depth)
+                                        max_depth=max_depth, cache=expand_cache)
                     if tree_mode:
                         all_trees.append(tree)
                     else:
-                        all_rules.extend(collect_leaf_rules(tree))
+                        all_rules.extend(_leaf_texts(tree, seen))
 
     if tree_mode:
         for tree in all_trees:
-            print(format_tree(tree))
-            print()
+            sys.stdout.writelines(f"{line}\n" for line in _format_tree_lines(tree))
+            sys.stdout.write("\n")
         return 0
 
     merged = _merge_rules(all_rules)
@@ -918,45 +1368,41 @@ def cmd_telookup(
 
 
 def _merge_rules(rules: list[str]) -> list[str]:
-    """Deduplicate and merge a flat list of policy rule strings."""
-    seen: dict[str, None] = {}
-    for r in rules:
-        seen.setdefault(r, None)
+    """Deduplicate and merge a flat list of policy rule strings.
 
+    Access vector rules sharing (type, source, target:class) are merged
+    into one rule at the position of the first of them; everything else
+    keeps its first-seen position.
+    """
     merged_perms: dict[str, dict[str, None]] = {}
-    merged_order: dict[str, int] = {}
-    other: list[tuple[int, str]] = []
+    # Output order: AV rule keys (merged_perms entries) and other rules verbatim.
+    order: list[tuple[str, bool]] = []
 
-    for pos, rule in enumerate(seen):
+    for rule in dict.fromkeys(rules):
         m = _AV_RULE.match(rule)
         if m:
             rule_type, source, target_class, perms_str = m.groups()
             key = f"{rule_type} {source} {target_class}"
-            if key not in merged_perms:
-                merged_perms[key] = {}
-                merged_order[key] = pos
+            perms = merged_perms.get(key)
+            if perms is None:
+                perms = merged_perms[key] = {}
+                order.append((key, True))
             for p in perms_str.split():
-                merged_perms[key].setdefault(p, None)
+                perms[p] = None
         else:
-            other.append((pos, rule))
+            order.append((rule, False))
 
-    result: list[tuple[int, str]] = list(other)
-    for key, perms in merged_perms.items():
-        result.append((merged_order[key], f"{key} {{ {' '.join(perms)} }};"))
-    result.sort(key=lambda x: x[0])
-    return [text for _, text in result]
+    return [
+        f"{text} {{ {' '.join(merged_perms[text])} }};" if is_av else text
+        for text, is_av in order
+    ]
 
 
-def cmd_deps(index: dict[str, MacroDef], name: str, mermaid: bool = False,
+def cmd_deps(index: MacroIndex, name: str, mermaid: bool = False,
              depth: int = DEFAULT_MAX_DEPTH) -> int:
     """Output a dependency graph showing which macros the given macro calls."""
     if name not in index:
-        print(f"semacro: macro '{name}' not found", file=sys.stderr)
-        near = [n for n in index if name.lower() in n.lower() and n != name]
-        if near:
-            print(f"  Did you mean: {', '.join(sorted(near)[:5])}", file=sys.stderr)
-        else:
-            print(f"  Try: semacro find \"{name}\"", file=sys.stderr)
+        _report_not_found(index, name)
         return 1
 
     edges: list[tuple[str, str]] = []
@@ -1104,46 +1550,8 @@ def _read_arg(value: str | None, command: str) -> str | None:
     return None
 
 
-def main() -> int:
-    global _use_color
-
-    parser = argparse.ArgumentParser(
-        prog="semacro",
-        description="Explore and expand SELinux policy macros, interfaces, and templates.",
-        epilog="Examples:\n"
-               "  semacro lookup files_pid_filetrans                          Show raw definition\n"
-               "  semacro lookup -e \"files_pid_filetrans(ntpd_t, ntpd_var_run_t, file)\"  Expand tree\n"
-               "  semacro lookup -r \"files_pid_filetrans(ntpd_t, ntpd_var_run_t, file)\"  Flat rules\n"
-               "  semacro find \"pid_filetrans\"                                Search by pattern\n"
-               "  semacro list --category kernel                              List kernel macros\n"
-               "  semacro callers filetrans_pattern                           Reverse lookup\n"
-               "  semacro which ntpd_t httpd_log_t read                       Find granting macro\n"
-               "  semacro telookup myapp.te                                   Expand a .te file\n"
-               "  semacro deps files_pid_filetrans                             Dependency graph\n"
-               "  semacro init myapp                                          Policy skeleton\n"
-               "\n"
-               "Policy path resolution (highest priority first):\n"
-               "  1. --include-path flag\n"
-               "  2. SEMACRO_INCLUDE_PATH environment variable\n"
-               "  3. /usr/share/selinux/devel/include (requires selinux-policy-devel)",
-        formatter_class=argparse.RawDescriptionHelpFormatter,
-    )
-    parser.add_argument(
-        "--version", "-V", action="version", version=f"%(prog)s {__version__}",
-    )
-    parser.add_argument(
-        "--no-color", action="store_true",
-        help="Disable colored output",
-    )
-    parser.add_argument(
-        "--include-path", metavar="DIR",
-        help="Path to SELinux policy include directory "
-             "(overrides SEMACRO_INCLUDE_PATH env var and default path)",
-    )
-
-    sub = parser.add_subparsers(dest="command")
-
-    # lookup
+def _add_lookup_parser(sub: argparse._SubParsersAction) -> None:
+    """Register the 'lookup' subcommand."""
     p_lookup = sub.add_parser(
         "lookup",
         help="Show or expand a macro definition",
@@ -1173,7 +1581,9 @@ def main() -> int:
     p_lookup.add_argument("-d", "--depth", type=int, default=DEFAULT_MAX_DEPTH,
                           help=f"Max expansion depth (default: {DEFAULT_MAX_DEPTH})")
 
-    # find
+
+def _add_find_parser(sub: argparse._SubParsersAction) -> None:
+    """Register the 'find' subcommand."""
     p_find = sub.add_parser(
         "find",
         help="Search for macros by name or by permissions",
@@ -1194,7 +1604,9 @@ def main() -> int:
                         help="Find defines whose value contains all listed permissions "
                              "(space-separated, order-independent)")
 
-    # list
+
+def _add_list_parser(sub: argparse._SubParsersAction) -> None:
+    """Register the 'list' subcommand."""
     p_list = sub.add_parser("list", help="List available macros")
     p_list.add_argument(
         "--category", "-c",
@@ -1203,7 +1615,9 @@ def main() -> int:
         help="Filter by policy category (default: all)",
     )
 
-    # callers
+
+def _add_callers_parser(sub: argparse._SubParsersAction) -> None:
+    """Register the 'callers' subcommand."""
     p_callers = sub.add_parser(
         "callers",
         help="Find which macros call a given macro (reverse lookup)",
@@ -1218,7 +1632,9 @@ def main() -> int:
     p_callers.add_argument("name", nargs="?", default=None,
                            help="Macro name to find callers for. Use - to read from stdin.")
 
-    # which
+
+def _add_which_parser(sub: argparse._SubParsersAction) -> None:
+    """Register the 'which' subcommand."""
     p_which = sub.add_parser(
         "which",
         help="Find macros that grant a specific access",
@@ -1244,7 +1660,9 @@ def main() -> int:
     p_which.add_argument("-N", "--name", dest="trans_name", metavar="FILENAME",
                          help="Filter by named transition filename (only with -T)")
 
-    # telookup
+
+def _add_telookup_parser(sub: argparse._SubParsersAction) -> None:
+    """Register the 'telookup' subcommand."""
     p_telookup = sub.add_parser(
         "telookup",
         help="Expand all macros in a .te policy file",
@@ -1265,7 +1683,9 @@ def main() -> int:
     p_telookup.add_argument("-e", "--expand", action="store_true",
                             help="Output expansion trees instead of flat rules")
 
-    # deps
+
+def _add_deps_parser(sub: argparse._SubParsersAction) -> None:
+    """Register the 'deps' subcommand."""
     p_deps = sub.add_parser(
         "deps",
         help="Show macro dependency graph in DOT or Mermaid format",
@@ -1286,7 +1706,9 @@ def main() -> int:
     p_deps.add_argument("-d", "--depth", type=int, default=DEFAULT_MAX_DEPTH,
                         help=f"Max depth to follow calls (default: {DEFAULT_MAX_DEPTH})")
 
-    # init
+
+def _add_init_parser(sub: argparse._SubParsersAction) -> None:
+    """Register the 'init' subcommand."""
     p_init = sub.add_parser(
         "init",
         help="Generate starter .te/.if/.fc files for a new policy module",
@@ -1303,6 +1725,91 @@ def main() -> int:
     p_init.add_argument("-o", "--output-dir", default=".",
                         help="Directory to create files in (default: current directory)")
 
+
+_COMMAND_PARSERS: dict[str, Callable[[argparse._SubParsersAction], None]] = {
+    "lookup": _add_lookup_parser,
+    "find": _add_find_parser,
+    "list": _add_list_parser,
+    "callers": _add_callers_parser,
+    "which": _add_which_parser,
+    "telookup": _add_telookup_parser,
+    "deps": _add_deps_parser,
+    "init": _add_init_parser,
+}
+
+
+def _requested_command(argv: list[str]) -> str | None:
+    """Return the subcommand named in argv, if it is clear without full parsing.
+
+    Returns None when top-level help is asked for, or on an option or word
+    this quick scan doesn't know, so the caller builds every subparser and
+    lets argparse produce its usual help and errors.
+    """
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg in ("--no-color", "--reindex") or arg.startswith("--include-path="):
+            i += 1
+        elif arg == "--include-path":
+            i += 2
+        elif arg.startswith("-"):
+            return None
+        else:
+            return arg if arg in _COMMAND_PARSERS else None
+    return None
+
+
+def main() -> int:
+    global colored
+
+    parser = argparse.ArgumentParser(
+        prog="semacro",
+        description="Explore and expand SELinux policy macros, interfaces, and templates.",
+        epilog="Examples:\n"
+               "  semacro lookup files_pid_filetrans                          Show raw definition\n"
+               "  semacro lookup -e \"files_pid_filetrans(ntpd_t, ntpd_var_run_t, file)\"  Expand tree\n"
+               "  semacro lookup -r \"files_pid_filetrans(ntpd_t, ntpd_var_run_t, file)\"  Flat rules\n"
+               "  semacro find \"pid_filetrans\"                                Search by pattern\n"
+               "  semacro list --category kernel                              List kernel macros\n"
+               "  semacro callers filetrans_pattern                           Reverse lookup\n"
+               "  semacro which ntpd_t httpd_log_t read                       Find granting macro\n"
+               "  semacro telookup myapp.te                                   Expand a .te file\n"
+               "  semacro deps files_pid_filetrans                             Dependency graph\n"
+               "  semacro init myapp                                          Policy skeleton\n"
+               "\n"
+               "Policy path resolution (highest priority first):\n"
+               "  1. --include-path flag\n"
+               "  2. SEMACRO_INCLUDE_PATH environment variable\n"
+               "  3. /usr/share/selinux/devel/include (requires selinux-policy-devel)",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "--version", "-V", action="version", version=f"%(prog)s {__version__}",
+    )
+    parser.add_argument(
+        "--no-color", action="store_true",
+        help="Disable colored output",
+    )
+    parser.add_argument(
+        "--include-path", metavar="DIR",
+        help="Path to SELinux policy include directory "
+             "(overrides SEMACRO_INCLUDE_PATH env var and default path)",
+    )
+    parser.add_argument(
+        "--reindex", action="store_true",
+        help="Ignore the cached index and re-parse every policy file",
+    )
+
+    sub = parser.add_subparsers(dest="command")
+    # Building every subparser is a noticeable share of a warm run, so
+    # when the command is known only its parser is constructed.
+    command = _requested_command(sys.argv[1:])
+    if command is not None:
+        _COMMAND_PARSERS[command](sub)
+    else:
+        for add_parser in _COMMAND_PARSERS.values():
+            add_parser(sub)
+
     args, unknown = parser.parse_known_args()
 
     if unknown:
@@ -1325,7 +1832,7 @@ def main() -> int:
         return cmd_init(args.name, output_dir=args.output_dir)
 
     if args.no_color or not sys.stdout.isatty():
-        _use_color = False
+        colored = _plain
 
     include_path = args.include_path or os.environ.get("SEMACRO_INCLUDE_PATH") or detect_include_path()
     if not include_path:
@@ -1343,19 +1850,17 @@ def main() -> int:
         print(f"semacro: include path '{include_path}' does not exist", file=sys.stderr)
         return 1
 
-    index = load_or_build_index(include_path)
+    index = load_or_build_index(include_path, reindex=args.reindex)
 
     if not index:
         print(f"semacro: no macros found under '{include_path}'", file=sys.stderr)
         return 1
 
-    has_support = any(m.kind == "define" for m in index.values())
-    has_kernel = any("kernel" in m.source_file for m in index.values())
-    if not has_support or not has_kernel:
+    if not index.has_define or not index.has_kernel:
         missing = []
-        if not has_support:
+        if not index.has_define:
             missing.append("support/*.spt (defines)")
-        if not has_kernel:
+        if not index.has_kernel:
             missing.append("kernel/*.if (core interfaces)")
         print(
             f"semacro: warning: incomplete policy tree — missing {', '.join(missing)}.\n"
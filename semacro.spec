@@ -8,7 +8,7 @@ URL:            https://github.com/pranlawate/semacro
 Source0:        %{name}-%{version}.tar.gz
 
 BuildArch:      noarch
-Requires:       python3 >= 3.9
+Requires:       python3 >= 3.10
 Requires:       selinux-policy-devel
 
 %description